@@ -1,116 +1,67 @@
-# pip install pandas pymongo python-dateutil
-import json
-from datetime import datetime
-from dateutil.tz import tzutc
-from pymongo import MongoClient, UpdateOne
-import numpy as np
-from pathlib import Path
-import pandas as pd
+# pip install "pymongo>=3.9" "ijson>=3.1"  (optional: zstandard)
+import ijson
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import lru_cache
+from pymongo import MongoClient, UpdateOne, WriteConcern
 
 # ---------- helpers ----------
-def to_dt(s):
-    """Parse ISO or {dueDate, dueTime} dicts into a Python datetime (UTC)."""
-    if s is None:
+@lru_cache(maxsize=None)
+def _parse_iso(s):
+    # many docs share the same timestamp string, so each distinct one is parsed once
+    try:
+        return datetime.fromisoformat(s.replace("Z", "+00:00")).astimezone(timezone.utc)
+    except ValueError:
         return None
-    if isinstance(s, str):
-        try:
-            # handle '2025-08-30T19:27:44.005Z'
-            return datetime.fromisoformat(s.replace("Z", "+00:00")).astimezone(tzutc())
-        except Exception:
-            return None
-    if isinstance(s, dict) and {"year","month","day"} <= set(s.get("dueDate", s).keys()):
-        d = s.get("dueDate", s)
-        t = s.get("dueTime", {})
-        hh, mm = int(t.get("hours", 0)), int(t.get("minutes", 0))
-        return datetime(int(d["year"]), int(d["month"]), int(d["day"]), hh, mm, tzinfo=tzutc())
-    return None
-
-def df_to_docs(df: pd.DataFrame):
-    """NaN->None and convert DataFrame to list of dicts."""
-    if df is None or df.empty:
-        return []
-    return df.replace({np.nan: None}).to_dict("records")
-
-# ---------- load ----------
 
-json_directory = "classroom_data"
-
-json_files = sorted(Path(json_directory).glob("classroom_data_*.json"),reverse=True)
-
-with open(json_files[0],"r",encoding="UTF-8") as f:
-    raw = json.load(f)
-    
-courses_raw = raw["courses"]
-
-# ---------- build DataFrames with json_normalize ----------
-# Courses (flat course_info)
-courses_df = pd.json_normalize(courses_raw, record_path=None, meta=None)
-courses_df = pd.json_normalize(courses_df["course_info"])  # keep just course_info
-courses_df.rename(columns={"id":"courseId"}, inplace=True)
-courses_df["creationTime"] = courses_df["creationTime"].map(to_dt)
-courses_df["updateTime"]  = courses_df["updateTime"].map(to_dt)
-
-# Students
-students_df = pd.json_normalize(
-    courses_raw,
-    record_path=["students"],
-    meta=[["course_info","id"]],
-    sep="."
-)
-students_df.rename(columns={"course_info.id":"courseId"}, inplace=True)
-
-# Teachers
-teachers_df = pd.json_normalize(
-    courses_raw,
-    record_path=["teachers"],
-    meta=[["course_info","id"]],
-    sep="."
-)
-teachers_df.rename(columns={"course_info.id":"courseId"}, inplace=True)
-
-# Assignments
-assignments_df = pd.json_normalize(
-    courses_raw,
-    record_path=["assignments"],
-    meta=[["course_info","id"]],
-    sep="."
-)
-assignments_df.rename(columns={"course_info.id":"courseId", "id":"assignmentId"}, inplace=True)
-
-# unify due datetime (may be missing on some)
-assignments_df["dueDateTime"] = assignments_df.apply(
-    lambda r: to_dt({"dueDate": r.get("dueDate", None), "dueTime": r.get("dueTime", None)}), axis=1
-)
-assignments_df["creationTime"] = assignments_df["creationTime"].map(to_dt)
-assignments_df["updateTime"]   = assignments_df["updateTime"].map(to_dt)
-
-# Submissions (1 row per submission)
-submissions_df = pd.json_normalize(
-    courses_raw,
-    record_path=["assignments","submissions"],
-    meta=[
-        ["course_info","id"],                 # parent course
-        ["assignments","id"],                 # parent assignment
-        ["assignments","title"],              # for convenience
-    ],
-    sep=".",
-    errors="ignore"
-)
-submissions_df.rename(columns={
-    "course_info.id":"courseId",
-    "assignments.id":"assignmentId",
-    "assignments.title":"assignmentTitle",
-    "id":"submissionId"
-}, inplace=True)
-
-# Parse timestamps
-for col in ("creationTime","updateTime"):
-    if col in submissions_df:
-        submissions_df[col] = submissions_df[col].map(to_dt)
+def parse_ts(s):
+    """Parse an ISO string like '2025-08-30T19:27:44.005Z' into a UTC datetime (None if invalid)."""
+    if not isinstance(s, str):
+        return None
+    return _parse_iso(s)
+
+def parse_times(doc):
+    """Convert the creationTime/updateTime strings of a doc in place."""
+    for col in ("creationTime", "updateTime"):
+        if col in doc:
+            doc[col] = parse_ts(doc[col])
+    return doc
+
+def due_dt(due_date, due_time):
+    """Combine {year, month, day} and {hours, minutes} into a UTC datetime (None without a date)."""
+    if not isinstance(due_date, dict) or not {"year", "month", "day"} <= due_date.keys():
+        return None
+    t = due_time or {}
+    return datetime(int(due_date["year"]), int(due_date["month"]), int(due_date["day"]),
+                    int(t.get("hours", 0)), int(t.get("minutes", 0)), tzinfo=timezone.utc)
+
+def flatten(d, prefix="", out=None, sep="."):
+    """Flatten nested dicts into dotted keys (lists are kept as-is), like json_normalize."""
+    if out is None:
+        out = {}
+    base = prefix + sep if prefix else ""  # build the key prefix once per level, not per key
+    for k, v in d.items():
+        if type(v) is dict:  # parsed JSON only ever holds plain dicts
+            flatten(v, base + k, out, sep)
+        else:
+            out[base + k] = v
+    return out
+
+def unflatten(d, sep="."):
+    """Nest dotted keys back into subdocuments: the shape `$set` builds from the same keys."""
+    out = {}
+    for key, v in d.items():
+        *parents, leaf = key.split(sep)
+        node = out
+        for p in parents:
+            node = node.setdefault(p, {})
+        node[leaf] = v
+    return out
 
 # Extract a clean attachments list (drive files only)
-def extract_attachments(row):
-    x = row.get("assignmentSubmission.attachments", None)
+def extract_attachments(x):
     if not isinstance(x, list):
         return None
     out = []
@@ -127,33 +78,82 @@ def extract_attachments(row):
             })
     return out or None
 
-submissions_df["attachments"] = submissions_df.apply(extract_attachments, axis=1)
-
 # Latest grade (if present in gradeHistory)
 def pick_latest_points(hist):
-    if not isinstance(hist, list) or not hist:
+    if not isinstance(hist, list):
         return None
-    # keep last entry with pointsEarned
-    pts = None
-    for h in hist:
+    # scan from the end: the first entry with pointsEarned is the latest one
+    for h in reversed(hist):
         gh = h.get("gradeHistory") if isinstance(h, dict) else None
         if isinstance(gh, dict) and "pointsEarned" in gh:
-            pts = gh["pointsEarned"]
-    return pts
+            return gh["pointsEarned"]
+    return None
 
-submissions_df["pointsEarned_latest"] = submissions_df["submissionHistory"].map(pick_latest_points)
-submissions_df["late"] = submissions_df.get("late", False).fillna(False)
+def iter_courses(path):
+    """Yield each entry of the dump's "courses" array without loading the whole file."""
+    with open(path, "rb") as f:
+        # use_float: BSON can't encode the Decimal values ijson yields by default
+        yield from ijson.items(f, "courses.item", use_float=True)
 
-# Keep only practical columns (optional; drop the massive histories if you want)
-keep_sub_cols = [
-    "submissionId","courseId","assignmentId","assignmentTitle","userId",
-    "state","creationTime","updateTime","late","draftGrade",
-    "pointsEarned_latest","attachments","alternateLink"
-]
-submissions_df = submissions_df[[c for c in keep_sub_cols if c in submissions_df.columns]]
+# ---------- load ----------
+
+json_directory = "classroom_data"
+
+# newest dump = greatest timestamped name; one directory pass, no sort
+with os.scandir(json_directory) as entries:
+    latest = max(
+        (e for e in entries if e.name.startswith("classroom_data_") and e.name.endswith(".json")),
+        key=lambda e: e.name,
+        default=None,
+    )
+if latest is None:
+    sys.exit(f"No dump found in {json_directory}/ (expected classroom_data_*.json)")
+
+# stream the courses one at a time instead of materializing the whole dump
+courses_raw = iter_courses(latest.path)
+
+# ---------- build docs (single pass over courses_raw, no DataFrames) ----------
+# Submission fields copied straight from the raw submission; everything else
+# (notably the massive submissionHistory) is never flattened or copied
+sub_fields = ("userId", "state", "creationTime", "updateTime", "late", "draftGrade", "alternateLink")
+
+courses_docs, students_docs, teachers_docs, assignments_docs, submissions_docs = [], [], [], [], []
+
+for course in courses_raw:
+    cid = course["course_info"]["id"]
+
+    # Courses (flat course_info)
+    doc = parse_times(flatten(course["course_info"]))
+    doc["courseId"] = doc.pop("id")
+    courses_docs.append(doc)
+
+    students_docs.extend({**flatten(s), "courseId": cid} for s in course.get("students", []))
+    teachers_docs.extend({**flatten(t), "courseId": cid} for t in course.get("teachers", []))
+
+    for a in course.get("assignments", []):
+        doc = parse_times(flatten(a))
+        doc["assignmentId"] = doc.pop("id")
+        doc["courseId"] = cid
+        doc.pop("submissions", None)  # stored in their own collection below
+        # unify due datetime (may be missing on some)
+        doc["dueDateTime"] = due_dt(a.get("dueDate"), a.get("dueTime"))
+        assignments_docs.append(doc)
+
+        # Submissions (1 doc per submission)
+        for sub in a.get("submissions", []):
+            doc = parse_times({c: sub[c] for c in sub_fields if c in sub})
+            doc["submissionId"] = sub.get("id")
+            doc["courseId"] = cid                      # parent course
+            doc["assignmentId"] = a["id"]              # parent assignment
+            doc["assignmentTitle"] = a.get("title")    # for convenience
+            doc["attachments"] = extract_attachments((sub.get("assignmentSubmission") or {}).get("attachments"))
+            doc["pointsEarned_latest"] = pick_latest_points(sub.get("submissionHistory"))
+            doc["late"] = doc.get("late") or False
+            submissions_docs.append(doc)
 
 # ---------- write to MongoDB (upserts with indexes) ----------
-client = MongoClient("mongodb://localhost:27017")  # change to your URI
+# zstd wire compression is used when the `zstandard` package is installed (pymongo skips it otherwise)
+client = MongoClient("mongodb://localhost:27017", retryWrites=False, compressors="zstd")  # change to your URI
 db = client["classroom"]
 cols = {
     "courses": db.courses,
@@ -163,27 +163,81 @@ cols = {
     "submissions": db.submissions,
 }
 
-# Create unique indexes (safe to rerun)
-cols["courses"].create_index("courseId", unique=True)
-cols["students"].create_index([("courseId", 1), ("userId", 1)], unique=True)
-cols["teachers"].create_index([("courseId", 1), ("userId", 1)], unique=True)
-cols["assignments"].create_index([("courseId", 1), ("assignmentId", 1)], unique=True)
-cols["submissions"].create_index([("assignmentId", 1), ("submissionId", 1)], unique=True)
+# Unique indexes per collection
+indexes = {
+    "courses": [("courseId", 1)],
+    "students": [("courseId", 1), ("userId", 1)],
+    "teachers": [("courseId", 1), ("userId", 1)],
+    "assignments": [("courseId", 1), ("assignmentId", 1)],
+    "submissions": [("assignmentId", 1), ("submissionId", 1)],
+}
+
+def create_indexes():
+    """Create the unique indexes (safe to rerun)."""
+    for name, keys in indexes.items():
+        cols[name].create_index(keys, unique=True)
+
+# `python script.py --full-reload` drops and rebuilds the collections instead of upserting into them
+FULL_RELOAD = "--full-reload" in sys.argv
+
+if FULL_RELOAD:
+    # no per-document index probes during the load; indexes are rebuilt once at the end
+    for col in cols.values():
+        col.drop()
+else:
+    create_indexes()
 
-def upsert(df, col, key_fields):
-    docs = df_to_docs(df)
+BATCH_SIZE = 1000  # chosen chunk size (pymongo still splits by the server limits); keeps each w=0 send small
+# the reimport is idempotent (rerun to repair), so batches are fire-and-forget instead of waiting for an ack
+BULK_WRITE_CONCERN = WriteConcern(w=0)
+
+def dedupe_by_key(docs, key_fields):
+    """Keep the last doc per key and return them sorted by key (sequential index access)."""
+    by_key = {tuple(d[k] for k in key_fields): d for d in docs}
+    return [by_key[k] for k in sorted(by_key, key=lambda k: tuple("" if v is None else v for v in k))]
+
+def upsert(docs, col, key_fields):
     if not docs:
         return
-    ops = []
-    for d in docs:
-        filt = {k: d[k] for k in key_fields}
-        ops.append(UpdateOne(filt, {"$set": d}, upsert=True))
-    col.bulk_write(ops, ordered=False)
-
-upsert(courses_df,    cols["courses"],    ["courseId"])
-upsert(students_df,   cols["students"],   ["courseId","userId"])
-upsert(teachers_df,   cols["teachers"],   ["courseId","userId"])
-upsert(assignments_df,cols["assignments"],["courseId","assignmentId"])
-upsert(submissions_df,cols["submissions"],["assignmentId","submissionId"])
-
+    docs = dedupe_by_key(docs, key_fields)
+    col = col.with_options(write_concern=BULK_WRITE_CONCERN)
+    ops = [UpdateOne({k: d[k] for k in key_fields}, {"$set": d}, upsert=True) for d in docs]
+    for i in range(0, len(ops), BATCH_SIZE):
+        # bypass_document_validation is rejected for unacknowledged writes
+        col.bulk_write(ops[i:i + BATCH_SIZE], ordered=False)
+
+def reload(docs, col, key_fields):
+    """Full refresh: plain inserts into the emptied, index-free collection."""
+    if not docs:
+        return
+    # duplicates would make the unique index build fail, so drop them here
+    docs = dedupe_by_key(docs, key_fields)
+    # acknowledged on purpose: the unique indexes built afterwards must see every document;
+    # unflatten so inserts store the same nested shape the upsert path's `$set` produces
+    col.insert_many([unflatten(d) for d in docs], ordered=False)
+
+# collections are independent, so write them concurrently (MongoClient is thread-safe and pooled)
+jobs = [
+    (courses_docs,    cols["courses"],    ["courseId"]),
+    (students_docs,   cols["students"],   ["courseId","userId"]),
+    (teachers_docs,   cols["teachers"],   ["courseId","userId"]),
+    (assignments_docs,cols["assignments"],["courseId","assignmentId"]),
+    (submissions_docs,cols["submissions"],["assignmentId","submissionId"]),
+]
+write = reload if FULL_RELOAD else upsert
+with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+    for future in [executor.submit(write, *job) for job in jobs]:
+        # re-raises client-side errors; in upsert (w=0) mode server-side write failures are not reported
+        future.result()
+
+if FULL_RELOAD:
+    create_indexes()
+
+# Acknowledged round-trip after the fire-and-forget batches: confirms the server is still reachable,
+# and the counts give a sanity check of what it holds (the last w=0 batches may still be applying)
+db.command("ping")
+for name, col in cols.items():
+    print(f"{name}: {col.estimated_document_count()} docs")
+
+client.close()
 print("Done.")
@@ -1,16 +1,23 @@
 import os
-import json
-import pickle
-from datetime import datetime
+import threading
+import orjson
+from datetime import datetime, timedelta, timezone
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpRequest, build_http
+from google_auth_httplib2 import AuthorizedHttp
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 
 class ClassroomDataFetcher:
-    def __init__(self, credentials_file='credentials.json', token_file='token.pickle', max_workers=10):
+    # Classroom accepts at most 50 calls per batch request
+    BATCH_SIZE = 50
+    # Refresh the access token this long before it expires, so no API call waits on a refresh
+    REFRESH_MARGIN = timedelta(minutes=5)
+    
+    def __init__(self, credentials_file='credentials.json', token_file='token.json', max_workers=10):
         """
         Initialize the Classroom API client with parallel processing
         
@@ -34,6 +41,7 @@ class ClassroomDataFetcher:
         self.max_workers = max_workers
         self.service = None
         self.creds = None
+        self._local = threading.local()
         self._authenticate()
     
     def _authenticate(self):
@@ -45,52 +53,99 @@ class ClassroomDataFetcher:
         
         if os.path.exists(self.token_file):
             try:
-                with open(self.token_file, 'rb') as token:
-                    creds = pickle.load(token)
+                creds = Credentials.from_authorized_user_file(self.token_file, self.SCOPES)
             except Exception as e:
                 print(f"Error loading token: {e}")
         
-        if not creds or not creds.valid:
-            if creds and creds.expired and creds.refresh_token:
-                try:
-                    creds.refresh(Request())
-                except Exception:
+        # Refresh up-front when the token is expired or about to be
+        if creds and creds.refresh_token and self._is_stale(creds):
+            try:
+                creds.refresh(Request())
+                self._save_token(creds)
+            except Exception:
+                # a token that is merely close to expiry can still be used
+                if not creds.valid:
                     creds = None
-            
-            if not creds:
-                flow = InstalledAppFlow.from_client_secrets_file(
-                    self.credentials_file, self.SCOPES)
-                creds = flow.run_local_server(port=0)
-            
-            with open(self.token_file, 'wb') as token:
-                pickle.dump(creds, token)
+        
+        if not creds or not creds.valid:
+            flow = InstalledAppFlow.from_client_secrets_file(
+                self.credentials_file, self.SCOPES)
+            creds = flow.run_local_server(port=0)
+            self._save_token(creds)
         
         self.creds = creds
-        self.service = build('classroom', 'v1', credentials=creds)
+        self._schedule_refresh()
+        # A single service is shared by all threads; only the transport underneath is per-thread.
+        # static_discovery reads the discovery document bundled with googleapiclient: no fetch, no cache
+        self.service = build('classroom', 'v1', http=self._thread_http(),
+                             requestBuilder=self._build_request,
+                             static_discovery=True, cache_discovery=False)
         print("API client initialized")
     
-    def _get_service(self):
-        """Get a new service instance for thread-safe operations"""
-        return build('classroom', 'v1', credentials=self.creds)
+    def _is_stale(self, creds):
+        """True if the access token is expired or expires within REFRESH_MARGIN"""
+        return creds.expired or (
+            creds.expiry is not None and creds.expiry - datetime.now(timezone.utc).replace(tzinfo=None) < self.REFRESH_MARGIN)
+    
+    def _save_token(self, creds):
+        """Persist the credentials so the next run starts with a fresh token"""
+        with open(self.token_file, 'w') as token:
+            token.write(creds.to_json())
+    
+    def _schedule_refresh(self):
+        """Refresh the token in the background just before it goes stale (long exports)"""
+        if not self.creds.refresh_token or self.creds.expiry is None:
+            return
+        delay = (self.creds.expiry - self.REFRESH_MARGIN - datetime.now(timezone.utc).replace(tzinfo=None)).total_seconds()
+        timer = threading.Timer(max(delay, 0), self._background_refresh)
+        timer.daemon = True
+        timer.start()
+    
+    def _background_refresh(self):
+        try:
+            self.creds.refresh(Request())
+            self._save_token(self.creds)
+        except Exception as e:
+            print(f"Error refreshing token: {e}")
+            return
+        self._schedule_refresh()
+    
+    def _thread_http(self):
+        """Get this thread's authorized transport (httplib2.Http is not thread-safe)"""
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            # Kept alive for the thread's lifetime; responses come back gzip-encoded because
+            # googleapiclient sends Accept-Encoding: gzip plus the "(gzip)" user-agent Google requires
+            # and httplib2 decompresses them transparently
+            # build_http: the client's defaults (60 s socket timeout, no 308 redirect handling)
+            http = self._local.http = AuthorizedHttp(self.creds, http=build_http())
+        return http
+    
+    def _build_request(self, http, *args, **kwargs):
+        """Bind every request to the transport of the thread that builds it"""
+        return HttpRequest(self._thread_http(), *args, **kwargs)
     
-    def _paginated_fetch(self, service, method, **kwargs):
-        """Generic paginated fetch with better performance"""
+    def _paginated_fetch(self, service_method, data_key, **kwargs):
+        """Fetch every page of a list method and return the items stored under data_key
+        
+        A 403 is permanent (retrying won't help), so it yields what was fetched so far;
+        any other error is raised so the caller knows the result is incomplete.
+        """
         items = []
-        request = method(**kwargs)
+        page_token = None
         
-        while request is not None:
+        while True:
             try:
-                response = request.execute()
-                items.extend(response.get(list(response.keys())[0], []))
-                request = method(**kwargs, pageToken=response.get('nextPageToken'))
-                if 'nextPageToken' not in response:
-                    break
+                response = service_method(**kwargs, pageToken=page_token).execute()
             except HttpError as e:
-                if e.resp.status == 403:
-                    print(f"Permission denied: {kwargs}")
+                if e.resp.status != 403:
+                    raise
+                print(f"Permission denied: {kwargs}")
                 break
-            except Exception as e:
-                print(f"Error: {e}")
+            
+            items.extend(response.get(data_key, []))
+            page_token = response.get('nextPageToken')
+            if not page_token:
                 break
         
         return items
@@ -99,25 +154,20 @@ class ClassroomDataFetcher:
         """Fetch all courses"""
         print("Fetching courses...")
         try:
-            results = self.service.courses().list(pageSize=100).execute()
-            courses = results.get('courses', [])
-            
-            while 'nextPageToken' in results:
-                results = self.service.courses().list(
-                    pageSize=100,
-                    pageToken=results['nextPageToken']
-                ).execute()
-                courses.extend(results.get('courses', []))
-            
-            print(f"Found {len(courses)} courses")
-            return courses
+            courses = self._paginated_fetch(self.service.courses().list, 'courses', pageSize=100)
         except Exception as e:
             print(f"Error fetching courses: {e}")
             return []
+        print(f"Found {len(courses)} courses")
+        return courses
     
     def _fetch_course_data(self, course_id, course_name, include_submissions=True):
-        """Fetch all data for a single course using parallel requests"""
-        service = self._get_service()
+        """Fetch all data for a single course using parallel requests
+        
+        Returns (course_data, complete); complete is False if any sub-fetch failed.
+        """
+        service = self.service
+        complete = True
         
         course_data = {
             'students': [],
@@ -129,10 +179,18 @@ class ClassroomDataFetcher:
         # Fetch basic course data in parallel
         with ThreadPoolExecutor(max_workers=4) as executor:
             futures = {
-                'students': executor.submit(self._fetch_students, service, course_id),
-                'teachers': executor.submit(self._fetch_teachers, service, course_id),
-                'assignments': executor.submit(self._fetch_assignments, service, course_id),
-                'announcements': executor.submit(self._fetch_announcements, service, course_id)
+                'students': executor.submit(
+                    self._paginated_fetch, service.courses().students().list, 'students',
+                    courseId=course_id, pageSize=100),
+                'teachers': executor.submit(
+                    self._paginated_fetch, service.courses().teachers().list, 'teachers',
+                    courseId=course_id, pageSize=100),
+                'assignments': executor.submit(
+                    self._paginated_fetch, service.courses().courseWork().list, 'courseWork',
+                    courseId=course_id, pageSize=100),
+                'announcements': executor.submit(
+                    self._paginated_fetch, service.courses().announcements().list, 'announcements',
+                    courseId=course_id, pageSize=100)
             }
             
             for key, future in futures.items():
@@ -140,6 +198,7 @@ class ClassroomDataFetcher:
                     course_data[key] = future.result()
                 except Exception as e:
                     print(f"  Error fetching {key}: {e}")
+                    complete = False
         
         print(f"  Students: {len(course_data['students'])}, Teachers: {len(course_data['teachers'])}, "
               f"Assignments: {len(course_data['assignments'])}, Announcements: {len(course_data['announcements'])}")
@@ -147,127 +206,70 @@ class ClassroomDataFetcher:
         # Fetch submissions in parallel if requested
         if include_submissions and course_data['assignments']:
             print(f"  Fetching submissions for {len(course_data['assignments'])} assignments...")
-            course_data['assignments'] = self._fetch_all_submissions(
+            course_data['assignments'], submissions_complete = self._fetch_all_submissions(
                 service, course_id, course_data['assignments']
             )
+            complete = complete and submissions_complete
         
-        return course_data
-    
-    def _fetch_students(self, service, course_id):
-        """Fetch students for a course"""
-        try:
-            results = service.courses().students().list(courseId=course_id, pageSize=100).execute()
-            students = results.get('students', [])
-            
-            while 'nextPageToken' in results:
-                results = service.courses().students().list(
-                    courseId=course_id,
-                    pageSize=100,
-                    pageToken=results['nextPageToken']
-                ).execute()
-                students.extend(results.get('students', []))
-            
-            return students
-        except Exception:
-            return []
-    
-    def _fetch_teachers(self, service, course_id):
-        """Fetch teachers for a course"""
-        try:
-            results = service.courses().teachers().list(courseId=course_id, pageSize=100).execute()
-            teachers = results.get('teachers', [])
-            
-            while 'nextPageToken' in results:
-                results = service.courses().teachers().list(
-                    courseId=course_id,
-                    pageSize=100,
-                    pageToken=results['nextPageToken']
-                ).execute()
-                teachers.extend(results.get('teachers', []))
-            
-            return teachers
-        except Exception:
-            return []
-    
-    def _fetch_assignments(self, service, course_id):
-        """Fetch assignments for a course"""
-        try:
-            results = service.courses().courseWork().list(courseId=course_id, pageSize=100).execute()
-            assignments = results.get('courseWork', [])
-            
-            while 'nextPageToken' in results:
-                results = service.courses().courseWork().list(
-                    courseId=course_id,
-                    pageSize=100,
-                    pageToken=results['nextPageToken']
-                ).execute()
-                assignments.extend(results.get('courseWork', []))
-            
-            return assignments
-        except Exception:
-            return []
-    
-    def _fetch_announcements(self, service, course_id):
-        """Fetch announcements for a course"""
-        try:
-            results = service.courses().announcements().list(courseId=course_id, pageSize=100).execute()
-            announcements = results.get('announcements', [])
-            
-            while 'nextPageToken' in results:
-                results = service.courses().announcements().list(
-                    courseId=course_id,
-                    pageSize=100,
-                    pageToken=results['nextPageToken']
-                ).execute()
-                announcements.extend(results.get('announcements', []))
-            
-            return announcements
-        except Exception:
-            return []
-    
-    def _fetch_single_assignment_submissions(self, service, course_id, assignment):
-        """Fetch submissions for a single assignment"""
-        assignment_id = assignment['id']
-        try:
-            results = service.courses().courseWork().studentSubmissions().list(
-                courseId=course_id,
-                courseWorkId=assignment_id,
-                pageSize=100
-            ).execute()
-            submissions = results.get('studentSubmissions', [])
-            
-            while 'nextPageToken' in results:
-                results = service.courses().courseWork().studentSubmissions().list(
-                    courseId=course_id,
-                    courseWorkId=assignment_id,
-                    pageSize=100,
-                    pageToken=results['nextPageToken']
-                ).execute()
-                submissions.extend(results.get('studentSubmissions', []))
-            
-            assignment['submissions'] = submissions
-            return assignment
-        except Exception:
-            assignment['submissions'] = []
-            return assignment
+        return course_data, complete
     
     def _fetch_all_submissions(self, service, course_id, assignments):
-        """Fetch submissions for all assignments in parallel"""
-        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-            futures = [
-                executor.submit(self._fetch_single_assignment_submissions, 
-                              self._get_service(), course_id, assignment)
-                for assignment in assignments
-            ]
+        """Fetch submissions for all assignments, coalescing the list calls into batch requests
+        
+        Returns (assignments, complete); complete is False if any page could not be fetched.
+        """
+        failed = False
+        by_id = {}
+        for assignment in assignments:
+            assignment['submissions'] = []
+            by_id[assignment['id']] = assignment
+        
+        # assignment id -> page token still to fetch (None = first page)
+        pending = dict.fromkeys(by_id)
+        
+        while pending:
+            next_pending = {}
+            
+            def on_response(request_id, response, exception):
+                nonlocal failed
+                if exception is not None:
+                    print(f"    Error fetching submissions: {exception}")
+                    # a 403 is permanent; anything else (quota, network) leaves the data incomplete
+                    if not (isinstance(exception, HttpError) and exception.resp.status == 403):
+                        failed = True
+                    return
+                by_id[request_id]['submissions'].extend(response.get('studentSubmissions', []))
+                if 'nextPageToken' in response:
+                    next_pending[request_id] = response['nextPageToken']
             
-            updated_assignments = []
-            for future in as_completed(futures):
+            page = list(pending.items())
+            for start in range(0, len(page), self.BATCH_SIZE):
+                batch = service.new_batch_http_request(callback=on_response)
+                for assignment_id, page_token in page[start:start + self.BATCH_SIZE]:
+                    batch.add(
+                        service.courses().courseWork().studentSubmissions().list(
+                            courseId=course_id,
+                            courseWorkId=assignment_id,
+                            pageSize=100,
+                            pageToken=page_token
+                        ),
+                        request_id=assignment_id
+                    )
                 try:
-                    updated_assignments.append(future.result())
+                    batch.execute()
                 except Exception as e:
                     print(f"    Error fetching submissions: {e}")
+                    failed = True
+            
+            pending = next_pending
         
-        return updated_assignments
+        return assignments, not failed
+    
+    @staticmethod
+    def _dumps(data):
+        """Serialize export data (compact output: the dump is read by scripts, not by hand)"""
+        return orjson.dumps(data, default=str,
+                            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
     
     def fetch_all_data(self, output_dir='classroom_data', include_submissions=True):
         """Fetch all data from Google Classroom using parallel processing"""
@@ -289,10 +291,33 @@ class ClassroomDataFetcher:
             print("No courses found.")
             return all_data
         
+        # Resume from the checkpoints of a previous, interrupted run
+        checkpoint_dir = os.path.join(output_dir, 'tmp')
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        course_ids = {course['id'] for course in courses}
+        done_ids = set()
+        for name in os.listdir(checkpoint_dir):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(checkpoint_dir, name)
+            course_id = name[:-len('.json')]
+            if course_id not in course_ids:
+                # Stale: the course is gone (deleted, archived, other account), so never export it
+                os.remove(path)
+                continue
+            with open(path, 'rb') as f:
+                all_data['courses'].append(orjson.loads(f.read()))
+            done_ids.add(course_id)
+        
+        if done_ids:
+            print(f"Resuming: {len(done_ids)} course(s) already fetched")
+        courses = [course for course in courses if course['id'] not in done_ids]
+        
         # Process courses in parallel
         print(f"\nProcessing {len(courses)} courses in parallel...")
         
-        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(courses))) as executor:
+        incomplete = 0
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(courses)))) as executor:
             futures = {
                 executor.submit(
                     self._fetch_course_data,
@@ -308,20 +333,44 @@ class ClassroomDataFetcher:
                 print(f"\n[{i}/{len(courses)}] Processing: {course_name}")
                 
                 try:
-                    course_data = future.result()
-                    all_data['courses'].append({
+                    course_data, complete = future.result()
+                    course_entry = {
                         'course_info': course,
                         **course_data
-                    })
+                    }
+                    if complete:
+                        # Checkpoint the course before moving on so a restart can skip it
+                        # (written under a temporary name so a crash never leaves half a file behind)
+                        checkpoint = os.path.join(checkpoint_dir, f"{course['id']}.json")
+                        with open(checkpoint + '.part', 'wb') as f:
+                            f.write(self._dumps(course_entry))
+                        os.replace(checkpoint + '.part', checkpoint)
+                    else:
+                        print("  Incomplete: not checkpointed, it will be fetched again on the next run")
+                        incomplete += 1
+                    all_data['courses'].append(course_entry)
                 except Exception as e:
                     print(f"  Error processing course: {e}")
+                    incomplete += 1
         
         # Save data
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        output_file = os.path.join(output_dir, f'classroom_data_{timestamp}.json')
+        # A partial export gets a name the classroom_data_*.json loader skips, so it is never
+        # picked up as the newest dump (and a --full-reload never replaces the data with it)
+        prefix = 'partial_classroom_data' if incomplete else 'classroom_data'
+        output_file = os.path.join(output_dir, f'{prefix}_{timestamp}.json')
+        
+        with open(output_file, 'wb') as f:
+            f.write(self._dumps(all_data))
         
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(all_data, f, indent=2, ensure_ascii=False, default=str)
+        if incomplete:
+            # Keep the checkpoints: the next run only refetches the courses that failed
+            print(f"\n{incomplete} course(s) incomplete; saved as a partial export that DFtoMongo skips; rerun to fetch them again")
+        else:
+            # The export is complete, so the next run must start fresh
+            for name in os.listdir(checkpoint_dir):
+                os.remove(os.path.join(checkpoint_dir, name))
+            os.rmdir(checkpoint_dir)
         
         print(f"\n{'=' * 50}")
         print(f"Export completed! Saved to: {output_file}")
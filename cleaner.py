@@ -1,33 +1,67 @@
 import os
-import pickle
 import json
 from datetime import datetime
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
+from googleapiclient.http import build_http
+from google_auth_httplib2 import AuthorizedHttp
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 
+# Start with minimal scopes to test authentication
+_MINIMAL_SCOPES = (
+    # 'https://www.googleapis.com/auth/classroom.courses.readonly',
+    'https://www.googleapis.com/auth/classroom.profile.emails',
+)
+
+_FULL_SCOPES = _MINIMAL_SCOPES + (
+    'https://www.googleapis.com/auth/classroom.courses.readonly',
+    'https://www.googleapis.com/auth/classroom.rosters.readonly',
+    # 'https://www.googleapis.com/auth/classroom.coursework.students.readonly',
+    # 'https://www.googleapis.com/auth/classroom.coursework.me.readonly',
+    'https://www.googleapis.com/auth/classroom.announcements.readonly',
+    'https://www.googleapis.com/auth/classroom.student-submissions.students.readonly',
+    'https://www.googleapis.com/auth/classroom.student-submissions.me.readonly',
+    'https://www.googleapis.com/auth/classroom.profile.photos',
+)
+
+# One Classroom client per credentials object; build() is expensive and each client holds its own connections
+_SERVICE_CACHE = {}
+
+def get_service(creds):
+    """Return the cached Classroom service for these credentials, building it on first use"""
+    service = _SERVICE_CACHE.get(id(creds))
+    if service is None:
+        # One long-lived Http per client, so every execute() after the first reuses its TLS connection;
+        # static_discovery uses the discovery document bundled with the client: no network fetch
+        http = AuthorizedHttp(creds, http=build_http())  # build_http keeps the 60 s default timeout
+        service = build('classroom', 'v1', http=http, cache_discovery=False, static_discovery=True)
+        _SERVICE_CACHE[id(creds)] = service
+    return service
+
 def cleanup_tokens():
     """Remove all authentication token files"""
-    token_files = ['token.pickle', 'token.pkl', 'credentials.pkl']
+    token_files = {'token.pickle', 'token.pkl', 'credentials.pkl', 'token_new.pickle', 'token.json', 'token_new.json'}
     cleaned = []
     
-    for token_file in token_files:
-        if os.path.exists(token_file):
-            try:
-                os.remove(token_file)
-                cleaned.append(token_file)
-                print(f"✅ Deleted: {token_file}")
-            except Exception as e:
-                print(f"❌ Could not delete {token_file}: {e}")
-        else:
-            print(f"ℹ️  File not found: {token_file}")
+    # One directory read tells us which token files exist
+    with os.scandir('.') as entries:
+        present = [entry for entry in entries if entry.name in token_files]
+    
+    msgs = []
+    for entry in present:
+        try:
+            os.unlink(entry.path)
+            cleaned.append(entry.name)
+        except Exception as e:
+            msgs.append(f"❌ Could not delete {entry.name}: {e}")
     
     if cleaned:
-        print(f"\n🧹 Cleaned up {len(cleaned)} token file(s)")
+        msgs.append(f"🧹 Cleaned up {len(cleaned)} token file(s): {', '.join(cleaned)}")
     else:
-        print("ℹ️  No token files found to clean up")
+        msgs.append("ℹ️  No token files found to clean up")
+    print("\n".join(msgs))
     
     return len(cleaned) > 0
 
@@ -35,12 +69,6 @@ def test_authentication():
     """Test authentication with minimal scopes first"""
     print("\n🔐 Testing authentication...")
     
-    # Start with minimal scopes to test authentication
-    MINIMAL_SCOPES = [
-        # 'https://www.googleapis.com/auth/classroom.courses.readonly',
-        'https://www.googleapis.com/auth/classroom.profile.emails'
-    ]
-    
     credentials_file = 'credentials.json'
     
     if not os.path.exists(credentials_file):
@@ -50,35 +78,35 @@ def test_authentication():
     try:
         print("Starting OAuth flow with minimal permissions...")
         flow = InstalledAppFlow.from_client_secrets_file(
-            credentials_file, MINIMAL_SCOPES)
+            credentials_file, _MINIMAL_SCOPES)
         
         # Use a specific port to avoid conflicts
         creds = flow.run_local_server(port=8080, prompt='select_account')
         
         # Test the credentials
-        service = build('classroom', 'v1', credentials=creds)
+        service = get_service(creds)
         
-        # Test API call
+        # Test API call (every call below asks only for the fields it prints, via `fields`)
         print("Testing API connection...")
-        profile = service.userProfiles().get(userId='me').execute()
+        profile = service.userProfiles().get(userId='me', fields='name/fullName,emailAddress').execute()
         
-        print(f"✅ Authentication successful!")
-        print(f"   User: {profile.get('name', {}).get('fullName', 'Unknown')}")
-        print(f"   Email: {profile.get('emailAddress', 'Unknown')}")
+        print("\n".join(["✅ Authentication successful!",
+                         f"   User: {profile.get('name', {}).get('fullName', 'Unknown')}",
+                         f"   Email: {profile.get('emailAddress', 'Unknown')}"]))
         
         # Test courses
         print("\nTesting course access...")
-        courses_result = service.courses().list(pageSize=10).execute()
+        courses_result = service.courses().list(pageSize=10, fields='courses(id,name,courseState)').execute()
         courses = courses_result.get('courses', [])
         
-        print(f"✅ Found {len(courses)} courses")
-        if courses:
-            for i, course in enumerate(courses[:3], 1):
-                print(f"   {i}. {course.get('name', 'Unknown')} ({course.get('courseState', 'Unknown')})")
-            if len(courses) > 3:
-                print(f"   ... and {len(courses) - 3} more")
+        msgs = [f"✅ Found {len(courses)} courses"]
+        for i, course in enumerate(courses[:3], 1):
+            msgs.append(f"   {i}. {course.get('name', 'Unknown')} ({course.get('courseState', 'Unknown')})")
+        if len(courses) > 3:
+            msgs.append(f"   ... and {len(courses) - 3} more")
+        print("\n".join(msgs))
         
-        return creds, service
+        return creds, service, courses
         
     except Exception as e:
         print(f"❌ Authentication failed: {e}")
@@ -88,31 +116,23 @@ def full_authentication():
     """Authenticate with all required scopes"""
     print("\n🔐 Authenticating with full permissions...")
     
-    FULL_SCOPES = [
-        'https://www.googleapis.com/auth/classroom.courses.readonly',
-        'https://www.googleapis.com/auth/classroom.rosters.readonly',
-        # 'https://www.googleapis.com/auth/classroom.coursework.students.readonly',
-        # 'https://www.googleapis.com/auth/classroom.coursework.me.readonly',
-        'https://www.googleapis.com/auth/classroom.announcements.readonly',
-        'https://www.googleapis.com/auth/classroom.student-submissions.students.readonly',
-        'https://www.googleapis.com/auth/classroom.student-submissions.me.readonly',
-        'https://www.googleapis.com/auth/classroom.profile.emails',
-        'https://www.googleapis.com/auth/classroom.profile.photos'
-    ]
-    
     credentials_file = 'credentials.json'
-    token_file = 'token_new.pickle'
+    token_file = 'token_new.json'
+    
+    if not os.path.exists(credentials_file):
+        print(f"❌ Credentials file '{credentials_file}' not found!")
+        return None
     
     try:
         print("Starting OAuth flow with full permissions...")
         flow = InstalledAppFlow.from_client_secrets_file(
-            credentials_file, FULL_SCOPES)
+            credentials_file, _FULL_SCOPES)
         
         creds = flow.run_local_server(port=8081, prompt='select_account')
         
-        # Save the new token
-        with open(token_file, 'wb') as token:
-            pickle.dump(creds, token)
+        # Save the new token (plain JSON, loadable with Credentials.from_authorized_user_file)
+        with open(token_file, 'w') as token:
+            token.write(creds.to_json())
         
         print(f"✅ Full authentication successful!")
         print(f"   Token saved as: {token_file}")
@@ -123,54 +143,57 @@ def full_authentication():
         print(f"❌ Full authentication failed: {e}")
         return None
 
-def quick_data_test(creds):
-    """Quick test to fetch some basic data"""
+def quick_data_test(service, courses):
+    """Quick test to fetch some basic data for the courses listed by test_authentication"""
     print("\n📚 Testing data access...")
     
     try:
-        service = build('classroom', 'v1', credentials=creds)
-        
-        # Get courses
-        courses_result = service.courses().list(pageSize=5).execute()
-        courses = courses_result.get('courses', [])
-        
         if not courses:
-            print("⚠️  No courses found. This could mean:")
-            print("   - You're not enrolled in or teaching any courses")
-            print("   - You need to be signed in with a different account")
+            print("\n".join(["⚠️  No courses found. This could mean:",
+                             "   - You're not enrolled in or teaching any courses",
+                             "   - You need to be signed in with a different account"]))
             return False
         
         print(f"📚 Testing with {len(courses)} course(s):")
         
-        for course in courses[:2]:  # Test first 2 courses
+        tested = courses[:2]  # Test first 2 courses
+        data_keys = {'students': 'students', 'coursework': 'courseWork'}
+        results = {}
+        
+        def on_response(request_id, response, exception):
+            kind = request_id.split(':', 1)[0]
+            if exception is None:
+                # only one record is fetched; a nextPageToken means there are more
+                found = len(response.get(data_keys[kind], []))
+                results[request_id] = f"{found}+" if response.get('nextPageToken') else found
+            elif isinstance(exception, HttpError) and exception.resp.status == 403:
+                results[request_id] = "Permission denied"
+            elif isinstance(exception, HttpError):
+                results[request_id] = f"Error ({exception.resp.status})"
+            else:
+                results[request_id] = f"Error ({exception})"
+        
+        # Send every probe in a single batched HTTP request instead of two round-trips per course;
+        # pageSize=1 bounds each probe to one record however large the course is
+        batch = service.new_batch_http_request(callback=on_response)
+        for course in tested:
+            course_id = course['id']
+            batch.add(service.courses().students().list(courseId=course_id, pageSize=1,
+                                                        fields='students/userId,nextPageToken'),
+                      request_id=f"students:{course_id}")
+            batch.add(service.courses().courseWork().list(courseId=course_id, pageSize=1,
+                                                          fields='courseWork/id,nextPageToken'),
+                      request_id=f"coursework:{course_id}")
+        batch.execute()
+        
+        msgs = []
+        for course in tested:
             course_id = course['id']
-            course_name = course.get('name', 'Unknown')
-            
-            print(f"\n   Testing course: {course_name}")
-            
-            # Test students
-            try:
-                students = service.courses().students().list(courseId=course_id).execute()
-                student_count = len(students.get('students', []))
-                print(f"     👥 Students: {student_count}")
-            except HttpError as e:
-                if e.resp.status == 403:
-                    print(f"     👥 Students: Permission denied")
-                else:
-                    print(f"     👥 Students: Error ({e.resp.status})")
-            
-            # Test assignments
-            try:
-                assignments = service.courses().courseWork().list(courseId=course_id).execute()
-                assignment_count = len(assignments.get('courseWork', []))
-                print(f"     📝 Assignments: {assignment_count}")
-            except HttpError as e:
-                if e.resp.status == 403:
-                    print(f"     📝 Assignments: Permission denied")
-                else:
-                    print(f"     📝 Assignments: Error ({e.resp.status})")
-        
-        print(f"\n✅ Data access test completed!")
+            msgs.append(f"\n   Testing course: {course.get('name', 'Unknown')}")
+            msgs.append(f"     👥 Students: {results[f'students:{course_id}']}")
+            msgs.append(f"     📝 Assignments: {results[f'coursework:{course_id}']}")
+        msgs.append("\n✅ Data access test completed!")
+        print("\n".join(msgs))
         return True
         
     except Exception as e:
@@ -181,6 +204,12 @@ def main():
     print("🧹 Google Classroom API Cleanup & Test Tool")
     print("=" * 50)
     
+    # Check before touching anything, so a broken setup doesn't wipe the existing tokens
+    if not os.path.exists('credentials.json'):
+        print("❌ Credentials file 'credentials.json' not found!")
+        print("Download your OAuth client credentials from the Google Cloud Console first.")
+        return
+    
     # Step 1: Clean up old tokens
     print("Step 1: Cleaning up old authentication tokens...")
     cleanup_tokens()
@@ -196,7 +225,7 @@ def main():
         print("3. You're using the correct Google account")
         return
     
-    creds, service = auth_result
+    creds, service, courses = auth_result
     
     # Step 3: Test full authentication
     print("\nStep 3: Setting up full permissions...")
@@ -207,22 +236,22 @@ def main():
         return
     
     # Step 4: Quick data test
-    success = quick_data_test(full_creds)
+    success = quick_data_test(get_service(full_creds), courses)
     
     if success:
         print("\n🎉 SUCCESS! Your authentication is working properly.")
         print("\nNext steps:")
-        print("1. You can now use 'token_new.pickle' as your token file")
+        print("1. You can now use 'token_new.json' as your token file")
         print("2. Update your main script to use this token file")
-        print("3. Or simply rename 'token_new.pickle' to 'token.pickle'")
+        print("3. Or simply rename 'token_new.json' to 'token.json'")
         
         # Ask if user wants to rename the token
         try:
-            rename = input("\nRename 'token_new.pickle' to 'token.pickle'? (y/n): ").strip().lower()
+            rename = input("\nRename 'token_new.json' to 'token.json'? (y/n): ").strip().lower()
             if rename in ['y', 'yes']:
-                if os.path.exists('token.pickle'):
-                    os.remove('token.pickle')
-                os.rename('token_new.pickle', 'token.pickle')
+                if os.path.exists('token.json'):
+                    os.remove('token.json')
+                os.rename('token_new.json', 'token.json')
                 print("✅ Token file renamed. You can now run your main script!")
         except KeyboardInterrupt:
             print("\nRename skipped. You can manually rename the file later.")